@@ -1,29 +1,116 @@
 from __future__ import annotations
 
-import json
+import dataclasses
+import itertools
+import math
 import os
 import random
+from functools import lru_cache
 from multiprocessing.managers import Namespace
-from typing import Optional, Callable
+from typing import Optional, Callable, Iterator
 from pathlib import Path
 
 import numpy as np
 import numpy.typing as npt
+import orjson
 import torch
+from numba import njit
 from omegaconf import DictConfig
 from pydub import AudioSegment
 from slider import Beatmap
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, default_collate
 
 from .data_utils import load_audio_file
 from .osu_parser import OsuParser
-from osuT5.tokenizer import Event, EventType, Tokenizer
+from osuT5.tokenizer import EventArray, EventType, Tokenizer, EVENT_TYPE_IDS
 
 OSZ_FILE_EXTENSION = ".osz"
 AUDIO_FILE_NAME = "audio.mp3"
 MILISECONDS_PER_SECOND = 1000
 STEPS_PER_MILLISECOND = 0.1
 LABEL_IGNORE_ID = -100
+DECODER_LENGTH_MULTIPLE = 64
+TIME_SHIFT_ID = EVENT_TYPE_IDS[EventType.TIME_SHIFT]
+ANCHOR_IDS = np.array([
+    EVENT_TYPE_IDS[EventType.BEZIER_ANCHOR],
+    EVENT_TYPE_IDS[EventType.PERFECT_ANCHOR],
+    EVENT_TYPE_IDS[EventType.CATMULL_ANCHOR],
+    EVENT_TYPE_IDS[EventType.RED_ANCHOR],
+], dtype=np.int8)
+# Lookup table from event type id to whether it is an anchor
+IS_ANCHOR = np.isin(np.arange(len(EVENT_TYPE_IDS)), ANCHOR_IDS)
+
+
+@njit(cache=True)
+def _trim_events(
+        types: npt.NDArray[np.int8],
+        values: npt.NDArray[np.float32],
+        start_time: float,
+        is_anchor: npt.NDArray[np.bool_],
+) -> tuple[npt.NDArray[np.int8], npt.NDArray[np.float32]]:
+    """Make time shifts relative to `start_time` in steps and remove time shifts of anchor events.
+
+    The input arrays are not modified, because they are views shared with other sequences.
+    """
+    n = len(types)
+    keep = np.empty(n, dtype=np.bool_)
+    count = 0
+
+    # Loop through the events in reverse to remove any time shifts that occur before anchor events
+    delete_next_time_shift = False
+    for i in range(n - 1, -1, -1):
+        keep[i] = True
+        if types[i] == TIME_SHIFT_ID:
+            if delete_next_time_shift:
+                delete_next_time_shift = False
+                keep[i] = False
+                continue
+        elif is_anchor[types[i]]:
+            delete_next_time_shift = True
+        count += 1
+
+    types_out = np.empty(count, dtype=types.dtype)
+    values_out = np.empty(count, dtype=values.dtype)
+    j = 0
+    for i in range(n):
+        if not keep[i]:
+            continue
+        types_out[j] = types[i]
+        if types[i] == TIME_SHIFT_ID:
+            values_out[j] = math.trunc((np.float64(values[i]) - start_time) * STEPS_PER_MILLISECOND)
+        else:
+            values_out[j] = values[i]
+        j += 1
+
+    return types_out, values_out
+
+
+@dataclasses.dataclass(slots=True)
+class Sequence:
+    """A split of a beatmap as it moves through the processing steps."""
+    time: float
+    frames: npt.NDArray | torch.Tensor
+    events: EventArray
+    beatmap_idx: int
+    difficulty: float
+    pre_events: Optional[EventArray] = None
+    other_events: Optional[EventArray] = None
+    other_beatmap_idx: Optional[int] = None
+    other_difficulty: Optional[float] = None
+    tokens: Optional[torch.Tensor] = None
+    pre_tokens: Optional[torch.Tensor] = None
+    other_tokens: Optional[torch.Tensor] = None
+    beatmap_idx_token: Optional[int] = None
+    difficulty_token: Optional[int] = None
+    other_beatmap_idx_token: Optional[int] = None
+    other_difficulty_token: Optional[int] = None
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class BeatmapMetadata:
+    """The fields of a beatmap in the track metadata that are used for training."""
+    index: int
+    difficulty: float
 
 
 class OrsDataset(IterableDataset):
@@ -37,6 +124,7 @@ class OrsDataset(IterableDataset):
         "beatmap_files",
         "test",
         "shared",
+        "batch_size",
     )
 
     def __init__(
@@ -47,6 +135,7 @@ class OrsDataset(IterableDataset):
             beatmap_files: Optional[list[Path]] = None,
             test: bool = False,
             shared: Namespace = None,
+            batch_size: Optional[int] = None,
     ):
         """Manage and process ORS dataset.
 
@@ -56,6 +145,7 @@ class OrsDataset(IterableDataset):
             tokenizer: Instance of Tokenizer class.
             beatmap_files: List of beatmap files to process. Overrides track index range.
             test: Whether to load the test dataset.
+            batch_size: Collate samples into batches of this size in the dataloader worker. None yields single samples.
         """
         super().__init__()
         self.path = args.test_dataset_path if test else args.train_dataset_path
@@ -67,6 +157,10 @@ class OrsDataset(IterableDataset):
         self.beatmap_files = beatmap_files
         self.test = test
         self.shared = shared
+        self.batch_size = batch_size
+
+        if args.length_bucket_batches > 0 and batch_size is None:
+            raise ValueError("length_bucket_batches requires collating batches in the dataloader workers")
 
     def _get_beatmap_files(self) -> list[Path]:
         if self.beatmap_files is not None:
@@ -76,19 +170,8 @@ class OrsDataset(IterableDataset):
         beatmap_files = []
         track_names = ["Track" + str(i).zfill(5) for i in range(self.start, self.end)]
         for track_name in track_names:
-            for beatmap_file in os.listdir(
-                    os.path.join(self.path, track_name, "beatmaps"),
-            ):
-                beatmap_files.append(
-                    Path(
-                        os.path.join(
-                            self.path,
-                            track_name,
-                            "beatmaps",
-                            beatmap_file,
-                        )
-                    ),
-                )
+            with os.scandir(os.path.join(self.path, track_name, "beatmaps")) as entries:
+                beatmap_files.extend(Path(entry.path) for entry in entries)
 
         return beatmap_files
 
@@ -96,23 +179,89 @@ class OrsDataset(IterableDataset):
         track_paths = []
         track_names = ["Track" + str(i).zfill(5) for i in range(self.start, self.end)]
         for track_name in track_names:
-            track_paths.append(Path(os.path.join(self.path, track_name)))
+            track_paths.append(Path(self.path, track_name))
         return track_paths
 
     def __iter__(self):
         beatmap_files = self._get_track_paths() if self.args.per_track else self._get_beatmap_files()
 
         if not self.test:
-            random.shuffle(beatmap_files)
+            if self.args.per_track:
+                random.shuffle(beatmap_files)
+            else:
+                beatmap_files = self._shuffle_by_track(beatmap_files)
 
         if self.args.cycle_length > 1 and not self.test:
-            return InterleavingBeatmapDatasetIterable(
+            iterator = InterleavingBeatmapDatasetIterable(
                 beatmap_files,
                 self._iterable_factory,
                 self.args.cycle_length,
             )
+        else:
+            iterator = self._iterable_factory(beatmap_files).__iter__()
+
+        if self.batch_size is not None:
+            return self._batch_iterator(iterator)
+
+        return iterator
+
+    def _batch_iterator(self, iterator: Iterator[dict]) -> Iterator[dict]:
+        """Collate samples into batches in the worker, so the dataset controls which samples share a batch.
+
+        With length bucketing, a pool of several batches worth of samples is sorted by decoder length
+        before batching, and each batch is trimmed to its longest decoder sequence. The test set is not
+        bucketed, because gathering predictions across processes requires equal decoder lengths.
+        """
+        batch_size = self.batch_size
+        length_bucketing = self.args.length_bucket_batches > 0 and not self.test
+        pool_size = batch_size * self.args.length_bucket_batches if length_bucketing else batch_size
+
+        while pool := list(itertools.islice(iterator, pool_size)):
+            if length_bucketing:
+                pool.sort(key=self._get_decoder_length)
+
+            batches = [pool[i:i + batch_size] for i in range(0, len(pool), batch_size)]
+            if length_bucketing:
+                random.shuffle(batches)
 
-        return self._iterable_factory(beatmap_files).__iter__()
+            for batch in batches:
+                batch = default_collate(batch)
+                if length_bucketing:
+                    batch = self._trim_decoder_padding(batch)
+                yield batch
+
+    @staticmethod
+    def _get_decoder_length(sample: dict) -> int:
+        """Get the index after the last non-padding decoder input token."""
+        return int(sample["decoder_attention_mask"].nonzero()[-1]) + 1
+
+    def _trim_decoder_padding(self, batch: dict) -> dict:
+        """Trim trailing padding shared by all decoder sequences in the batch.
+
+        The length is rounded up to a multiple of `DECODER_LENGTH_MULTIPLE`
+        to limit the number of distinct shapes the model sees.
+        """
+        length = int(batch["decoder_attention_mask"].any(dim=0).nonzero()[-1]) + 1
+        length = min(-(-length // DECODER_LENGTH_MULTIPLE) * DECODER_LENGTH_MULTIPLE, self.args.tgt_seq_len)
+        for key in ("decoder_input_ids", "decoder_attention_mask", "labels"):
+            # Copy so the untrimmed storage is not sent to the main process
+            batch[key] = batch[key][:, :length].contiguous()
+        return batch
+
+    @staticmethod
+    def _shuffle_by_track(beatmap_files: list[Path]) -> list[Path]:
+        """Shuffle beatmap files while keeping beatmaps of the same track together,
+        so the audio of a track only has to be loaded once."""
+        tracks: dict[Path, list[Path]] = {}
+        for beatmap_file in beatmap_files:
+            tracks.setdefault(beatmap_file.parents[1], []).append(beatmap_file)
+
+        track_files = list(tracks.values())
+        random.shuffle(track_files)
+        for files in track_files:
+            random.shuffle(files)
+
+        return [beatmap_file for files in track_files for beatmap_file in files]
 
     def _iterable_factory(self, beatmap_files: list[Path]):
         return BeatmapDatasetIterable(
@@ -150,15 +299,18 @@ class InterleavingBeatmapDatasetIterable:
         return self
 
     def __next__(self) -> tuple[any, int]:
-        num = len(self.workers)
-        for _ in range(num):
+        while self.workers:
+            self.index %= len(self.workers)
             try:
-                self.index = self.index % len(self.workers)
                 item = self.workers[self.index].__next__()
-                self.index += 1
-                return item
             except StopIteration:
-                self.workers.remove(self.workers[self.index])
+                # Swap the exhausted worker with the last one and pop it
+                last = self.workers.pop()
+                if self.index < len(self.workers):
+                    self.workers[self.index] = last
+                continue
+            self.index += 1
+            return item
         raise StopIteration
 
 
@@ -171,12 +323,16 @@ class BeatmapDatasetIterable:
         "test",
         "shared",
         "frame_seq_len",
+        "miliseconds_per_frame",
         "min_pre_token_len",
         "pre_token_len",
         "class_dropout_prob",
         "diff_dropout_prob",
         "add_pre_tokens",
         "add_empty_sequences",
+        "_rng",
+        "_input_template",
+        "_label_template",
     )
 
     def __init__(
@@ -197,6 +353,7 @@ class BeatmapDatasetIterable:
         # let N = |src_seq_len|
         # N-1 frames creates N mel-spectrogram frames
         self.frame_seq_len = args.src_seq_len - 1
+        self.miliseconds_per_frame = args.hop_length * MILISECONDS_PER_SECOND / args.sample_rate
         # let N = |tgt_seq_len|
         # [SOS] token + event_tokens + [EOS] token creates N+1 tokens
         # [SOS] token + event_tokens[:-1] creates N target sequence
@@ -207,39 +364,42 @@ class BeatmapDatasetIterable:
         self.diff_dropout_prob = 0 if self.test else args.diff_dropout_prob
         self.add_pre_tokens = args.add_pre_tokens
         self.add_empty_sequences = args.add_empty_sequences
+        # Seeded from the seeded `random` stream so dropout is reproducible per worker
+        self._rng = np.random.default_rng(random.getrandbits(64))
+        # Filled once and cloned for every sequence in _pad_and_split_token_sequence
+        self._input_template = torch.full((args.tgt_seq_len,), tokenizer.pad_id, dtype=torch.long)
+        self._label_template = torch.full((args.tgt_seq_len,), LABEL_IGNORE_ID, dtype=torch.long)
 
-    def _get_frames(self, samples: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+    def _get_frames(self, samples: npt.NDArray) -> npt.NDArray:
         """Segment audio samples into frames.
 
         Each frame has `frame_size` audio samples.
-        It will also calculate and return the time of each audio frame, in miliseconds.
+        The time of frame `i` is `i * miliseconds_per_frame`.
 
         Args:
             samples: Audio time-series.
 
         Returns:
             frames: Audio frames.
-            frame_times: Audio frame times.
         """
-        samples = np.pad(samples, [0, self.args.hop_length - len(samples) % self.args.hop_length])
-        frames = np.reshape(samples, (-1, self.args.hop_length))
-        frames_per_milisecond = (
-                self.args.sample_rate / self.args.hop_length / MILISECONDS_PER_SECOND
-        )
-        frame_times = np.arange(len(frames)) / frames_per_milisecond
-        return frames, frame_times
+        hop_length = self.args.hop_length
+        n_samples = len(samples)
+        # Zero-pad the tail into a preallocated buffer instead of np.pad, which copies twice
+        padded = np.empty(n_samples + (-n_samples) % hop_length, dtype=samples.dtype)
+        padded[:n_samples] = samples
+        padded[n_samples:] = 0
+        return padded.reshape(-1, hop_length)
 
     def _create_sequences(
             self,
             frames: npt.NDArray,
-            frame_times: npt.NDArray,
-            events: list[Event],
+            events: EventArray,
             beatmap_idx: int,
             difficulty: float,
-            other_events: Optional[list[Event]] = None,
+            other_events: Optional[EventArray] = None,
             other_beatmap_idx: Optional[int] = None,
             other_difficulty: Optional[float] = None,
-    ) -> list[dict[str, int | npt.NDArray | list[Event]]]:
+    ) -> list[Sequence]:
         """Create frame and token sequences for training/testing.
 
         Args:
@@ -249,22 +409,20 @@ class BeatmapDatasetIterable:
         Returns:
             A list of source and target sequences.
         """
+        frame_times = np.arange(len(frames), dtype=np.float64) * self.miliseconds_per_frame
 
-        def get_event_indices(events2: list[Event]) -> tuple[list[int], list[int]]:
-            # Corresponding start event index for every audio frame.
-            start_indices = []
-            event_index = 0
-            event_time = -np.inf
+        def get_event_indices(events2: EventArray) -> tuple[npt.NDArray, npt.NDArray]:
+            time_shift_indices = np.flatnonzero(events2.types == TIME_SHIFT_ID)
+            # Running maximum keeps the search valid for overlapping hit objects with out-of-order times
+            time_shift_times = np.maximum.accumulate(events2.values[time_shift_indices])
 
-            for current_time in frame_times:
-                while event_time < current_time and event_index < len(events2):
-                    if events2[event_index].type == EventType.TIME_SHIFT:
-                        event_time = events2[event_index].value
-                    event_index += 1
-                start_indices.append(event_index - 1)
+            # Corresponding start event index for every audio frame.
+            # This is the first time shift at or after the frame time, or the last event if there is none.
+            k = np.searchsorted(time_shift_times, frame_times, side="left")
+            start_indices = np.append(time_shift_indices, len(events2) - 1)[k]
 
             # Corresponding end event index for every audio frame.
-            end_indices = start_indices[1:] + [len(events2)]
+            end_indices = np.append(start_indices[1:], len(events2))
 
             return start_indices, end_indices
 
@@ -274,11 +432,12 @@ class BeatmapDatasetIterable:
         if other_events is not None:
             other_event_start_indices, other_event_end_indices = get_event_indices(other_events)
 
-        sequences = []
         n_frames = len(frames)
         offset = random.randint(0, self.frame_seq_len)
         # Divide audio frames into splits
-        for frame_start_idx in range(offset, n_frames, self.frame_seq_len):
+        frame_start_indices = range(offset, n_frames, self.frame_seq_len)
+        sequences: list[Optional[Sequence]] = [None] * len(frame_start_indices)
+        for i, frame_start_idx in enumerate(frame_start_indices):
             frame_end_idx = min(frame_start_idx + self.frame_seq_len, n_frames)
 
             target_start_idx = event_start_indices[frame_start_idx]
@@ -288,29 +447,29 @@ class BeatmapDatasetIterable:
             target_pre_idx = event_start_indices[frame_pre_idx]
 
             # Create the sequence
-            sequence = {
-                "time": frame_times[frame_start_idx],
-                "frames": frames[frame_start_idx:frame_end_idx],
-                "events": events[target_start_idx:target_end_idx],
-                "beatmap_idx": beatmap_idx,
-                "difficulty": difficulty,
-            }
+            sequence = Sequence(
+                time=frame_start_idx * self.miliseconds_per_frame,
+                frames=frames[frame_start_idx:frame_end_idx],
+                events=events[target_start_idx:target_end_idx],
+                beatmap_idx=beatmap_idx,
+                difficulty=difficulty,
+            )
 
             if self.args.add_pre_tokens or self.args.add_pre_tokens_at_step >= 0:
-                sequence["pre_events"] = events[target_pre_idx:target_start_idx]
+                sequence.pre_events = events[target_pre_idx:target_start_idx]
 
             if other_events is not None:
                 other_target_start_idx = other_event_start_indices[frame_start_idx]
                 other_target_end_idx = other_event_end_indices[frame_end_idx - 1]
-                sequence["other_events"] = other_events[other_target_start_idx:other_target_end_idx]
-                sequence["other_beatmap_idx"] = other_beatmap_idx
-                sequence["other_difficulty"] = other_difficulty
+                sequence.other_events = other_events[other_target_start_idx:other_target_end_idx]
+                sequence.other_beatmap_idx = other_beatmap_idx
+                sequence.other_difficulty = other_difficulty
 
-            sequences.append(sequence)
+            sequences[i] = sequence
 
         return sequences
 
-    def _trim_time_shifts(self, sequence: dict) -> dict:
+    def _trim_time_shifts(self, sequence: Sequence) -> Sequence:
         """Make all time shifts in the sequence relative to the start time of the sequence,
         and normalize time values,
         and remove any time shifts for anchor events.
@@ -322,39 +481,22 @@ class BeatmapDatasetIterable:
             The same sequence with trimmed time shifts.
         """
 
-        def process(events: list[Event], start_time) -> list[Event]:
-            for i, event in enumerate(events):
-                if event.type == EventType.TIME_SHIFT:
-                    # We cant modify the event objects themselves because that will affect subsequent sequences
-                    events[i] = Event(EventType.TIME_SHIFT, int((event.value - start_time) * STEPS_PER_MILLISECOND))
-
-            # Loop through the events in reverse to remove any time shifts that occur before anchor events
-            delete_next_time_shift = False
-            for i in range(len(events) - 1, -1, -1):
-                if events[i].type == EventType.TIME_SHIFT and delete_next_time_shift:
-                    delete_next_time_shift = False
-                    del events[i]
-                    continue
-                elif events[i].type in [EventType.BEZIER_ANCHOR, EventType.PERFECT_ANCHOR, EventType.CATMULL_ANCHOR,
-                                        EventType.RED_ANCHOR]:
-                    delete_next_time_shift = True
-
-            return events
+        def process(events: EventArray, start_time) -> EventArray:
+            return EventArray(*_trim_events(events.types, events.values, start_time, IS_ANCHOR))
 
-        start_time = sequence["time"]
-        del sequence["time"]
+        start_time = sequence.time
 
-        sequence["events"] = process(sequence["events"], start_time)
+        sequence.events = process(sequence.events, start_time)
 
-        if "pre_events" in sequence:
-            sequence["pre_events"] = process(sequence["pre_events"], start_time)
+        if sequence.pre_events is not None:
+            sequence.pre_events = process(sequence.pre_events, start_time)
 
-        if "other_events" in sequence:
-            sequence["other_events"] = process(sequence["other_events"], start_time)
+        if sequence.other_events is not None:
+            sequence.other_events = process(sequence.other_events, start_time)
 
         return sequence
 
-    def _tokenize_sequence(self, sequence: dict) -> dict:
+    def _tokenize_sequence(self, sequence: Sequence) -> Sequence:
         """Tokenize the event sequence.
 
         Begin token sequence with `[SOS]` token (start-of-sequence).
@@ -366,46 +508,53 @@ class BeatmapDatasetIterable:
         Returns:
             The same sequence with tokenized events.
         """
-        tokens = torch.empty(len(sequence["events"]) + 2, dtype=torch.long)
+        events = sequence.events
+        tokens = np.empty(len(events) + 2, dtype=np.int64)
         tokens[0] = self.tokenizer.sos_id
-        for i, event in enumerate(sequence["events"]):
-            tokens[i + 1] = self.tokenizer.encode(event)
+        self.tokenizer.encode_array(events.types, events.values, out=tokens[1:-1])
         tokens[-1] = self.tokenizer.eos_id
-        sequence["tokens"] = tokens
-        del sequence["events"]
+        # Tensors share memory with the numpy token arrays, no copies are made
+        sequence.tokens = torch.from_numpy(tokens)
 
-        if "pre_events" in sequence:
-            pre_tokens = torch.empty(len(sequence["pre_events"]), dtype=torch.long)
-            for i, event in enumerate(sequence["pre_events"]):
-                pre_tokens[i] = self.tokenizer.encode(event)
-            sequence["pre_tokens"] = pre_tokens
-            del sequence["pre_events"]
+        if sequence.pre_events is not None:
+            pre_events = sequence.pre_events
+            sequence.pre_tokens = torch.from_numpy(
+                self.tokenizer.encode_array(pre_events.types, pre_events.values),
+            )
 
-        sequence["beatmap_idx_token"] = self.tokenizer.encode_style_idx(sequence["beatmap_idx"]) \
-            if random.random() >= self.args.class_dropout_prob else self.tokenizer.style_unk
+        # Draw all dropout decisions at once: style, difficulty, beatmap idx, other style, other difficulty
+        keep_style, keep_diff, keep_idx, keep_other_style, keep_other_diff = self._rng.random(5) >= [
+            self.args.class_dropout_prob,
+            self.args.diff_dropout_prob,
+            self.args.class_dropout_prob,
+            self.args.class_dropout_prob,
+            self.args.diff_dropout_prob,
+        ]
 
-        sequence["difficulty_token"] = self.tokenizer.encode_diff(sequence["difficulty"]) \
-            if random.random() >= self.args.diff_dropout_prob else self.tokenizer.diff_unk
+        sequence.beatmap_idx_token = self.tokenizer.encode_style_idx(sequence.beatmap_idx) \
+            if keep_style else self.tokenizer.style_unk
 
-        sequence["beatmap_idx"] = sequence["beatmap_idx"] \
-            if random.random() >= self.args.class_dropout_prob else self.tokenizer.num_classes
+        sequence.difficulty_token = self.tokenizer.encode_diff(sequence.difficulty) \
+            if keep_diff else self.tokenizer.diff_unk
 
-        if "other_events" in sequence:
-            other_tokens = torch.empty(len(sequence["other_events"]), dtype=torch.long)
-            for i, event in enumerate(sequence["other_events"]):
-                other_tokens[i] = self.tokenizer.encode(event)
-            sequence["other_tokens"] = other_tokens
-            del sequence["other_events"]
+        sequence.beatmap_idx = sequence.beatmap_idx \
+            if keep_idx else self.tokenizer.num_classes
 
-            sequence["other_beatmap_idx_token"] = self.tokenizer.encode_style_idx(sequence["other_beatmap_idx"]) \
-                if random.random() >= self.args.class_dropout_prob else self.tokenizer.style_unk
+        if sequence.other_events is not None:
+            other_events = sequence.other_events
+            sequence.other_tokens = torch.from_numpy(
+                self.tokenizer.encode_array(other_events.types, other_events.values),
+            )
 
-            sequence["other_difficulty_token"] = self.tokenizer.encode_diff(sequence["other_difficulty"]) \
-                if random.random() >= self.args.diff_dropout_prob else self.tokenizer.diff_unk
+            sequence.other_beatmap_idx_token = self.tokenizer.encode_style_idx(sequence.other_beatmap_idx) \
+                if keep_other_style else self.tokenizer.style_unk
+
+            sequence.other_difficulty_token = self.tokenizer.encode_diff(sequence.other_difficulty) \
+                if keep_other_diff else self.tokenizer.diff_unk
 
         return sequence
 
-    def _pad_and_split_token_sequence(self, sequence: dict) -> dict:
+    def _pad_and_split_token_sequence(self, sequence: Sequence) -> dict[str, int | torch.Tensor]:
         """Pad token sequence to a fixed length and split decoder input and labels.
 
         Pad with `[PAD]` tokens until `tgt_seq_len`.
@@ -419,23 +568,24 @@ class BeatmapDatasetIterable:
             sequence: The input sequence.
 
         Returns:
-            The same sequence with padded tokens.
+            The model inputs of the sequence with padded tokens.
         """
         stl = self.args.special_token_len
 
-        tokens = sequence["tokens"]
-        pre_tokens = sequence["pre_tokens"] if "pre_tokens" in sequence else torch.empty(0, dtype=tokens.dtype)
+        tokens = sequence.tokens
+        pre_tokens = sequence.pre_tokens if sequence.pre_tokens is not None else torch.empty(0, dtype=tokens.dtype)
         num_pre_tokens = len(pre_tokens) if self.args.add_pre_tokens else 0
 
         if self.args.max_pre_token_len > 0:
             num_pre_tokens = min(num_pre_tokens, self.args.max_pre_token_len)
 
-        other_tokens = sequence["other_tokens"] if "other_tokens" in sequence else torch.empty(0, dtype=tokens.dtype)
-        num_other_tokens = len(other_tokens) + stl if "other_tokens" in sequence else 0
+        other_tokens = sequence.other_tokens if sequence.other_tokens is not None else torch.empty(0, dtype=tokens.dtype)
+        num_other_tokens = len(other_tokens) + stl if sequence.other_tokens is not None else 0
 
-        input_tokens = torch.full((self.args.tgt_seq_len,), self.tokenizer.pad_id, dtype=tokens.dtype,
-                                  device=tokens.device)
-        label_tokens = torch.full((self.args.tgt_seq_len,), LABEL_IGNORE_ID, dtype=tokens.dtype, device=tokens.device)
+        input_tokens = self._input_template.clone()
+        label_tokens = self._label_template.clone()
+        # Every position that gets a token is attended to, none of the tokens are [PAD]
+        attention_mask = torch.zeros(self.args.tgt_seq_len, dtype=torch.bool)
 
         if self.args.center_pad_decoder:
             n = min(self.args.tgt_seq_len - self.pre_token_len, len(tokens) - 1)
@@ -452,57 +602,54 @@ class BeatmapDatasetIterable:
 
         if o > 0:
             if self.args.diff_token_index >= 0:
-                input_tokens[start_index + self.args.diff_token_index] = sequence["other_difficulty_token"]
+                input_tokens[start_index + self.args.diff_token_index] = sequence.other_difficulty_token
+                attention_mask[start_index + self.args.diff_token_index] = True
             if self.args.style_token_index >= 0:
-                input_tokens[start_index + self.args.style_token_index] = sequence["other_beatmap_idx_token"]
+                input_tokens[start_index + self.args.style_token_index] = sequence.other_beatmap_idx_token
+                attention_mask[start_index + self.args.style_token_index] = True
             if o > stl:
                 input_tokens[start_index + stl:start_index + o] = other_tokens[:o - stl]
+                attention_mask[start_index + stl:start_index + o] = True
         start_index += o
 
         if self.args.diff_token_index >= 0:
-            input_tokens[start_index + self.args.diff_token_index] = sequence["difficulty_token"]
+            input_tokens[start_index + self.args.diff_token_index] = sequence.difficulty_token
+            attention_mask[start_index + self.args.diff_token_index] = True
         if self.args.style_token_index >= 0:
-            input_tokens[start_index + self.args.style_token_index] = sequence["beatmap_idx_token"]
+            input_tokens[start_index + self.args.style_token_index] = sequence.beatmap_idx_token
+            attention_mask[start_index + self.args.style_token_index] = True
         if m > 0:
             input_tokens[start_index + stl:start_index + m + stl] = pre_tokens[-m:]
         input_tokens[start_index + m + stl:start_index + m + stl + n] = tokens[:n]
         label_tokens[start_index + m + stl:start_index + m + stl + n] = tokens[1:n + 1]
+        attention_mask[start_index + stl:start_index + m + stl + n] = True
 
         # Randomize some input tokens
         if self.args.timing_random_offset > 0:
             offset = random.randint(-self.args.timing_random_offset, self.frame_seq_len)
-            input_tokens = torch.where((self.tokenizer.event_start[EventType.TIME_SHIFT] <= input_tokens) & (
-                        input_tokens < self.tokenizer.event_end[EventType.TIME_SHIFT]),
-                                       torch.clamp(input_tokens + offset,
-                                                   self.tokenizer.event_start[EventType.TIME_SHIFT],
-                                                   self.tokenizer.event_end[EventType.TIME_SHIFT] - 1),
-                                       input_tokens)
+            time_shift_start = self.tokenizer.event_start[EventType.TIME_SHIFT]
+            time_shift_end = self.tokenizer.event_end[EventType.TIME_SHIFT]
+            # Only shift and clamp the time shift tokens instead of the whole padded sequence
+            time_shifts = (time_shift_start <= input_tokens) & (input_tokens < time_shift_end)
+            input_tokens[time_shifts] = torch.clamp(
+                input_tokens[time_shifts] + offset,
+                time_shift_start,
+                time_shift_end - 1,
+            )
         # input_tokens = torch.where((self.tokenizer.event_start[EventType.DISTANCE] <= input_tokens) & (input_tokens < self.tokenizer.event_end[EventType.DISTANCE]),
         #                               torch.clamp(input_tokens + torch.randint_like(input_tokens, -10, 10), self.tokenizer.event_start[EventType.DISTANCE], self.tokenizer.event_end[EventType.DISTANCE] - 1),
         #                               input_tokens)
 
-        sequence["decoder_input_ids"] = input_tokens
-        sequence["decoder_attention_mask"] = input_tokens != self.tokenizer.pad_id
-        sequence["labels"] = label_tokens
-
-        del sequence["tokens"]
-        if "pre_tokens" in sequence:
-            del sequence["pre_tokens"]
-        del sequence["difficulty_token"]
-        del sequence["beatmap_idx_token"]
-        del sequence["difficulty"]
-        # We keep beatmap_idx because it is a model input
-
-        if "other_tokens" in sequence:
-            del sequence["other_tokens"]
-            del sequence["other_difficulty_token"]
-            del sequence["other_beatmap_idx_token"]
-            del sequence["other_difficulty"]
-            del sequence["other_beatmap_idx"]
+        return {
+            "frames": sequence.frames,
+            # We keep beatmap_idx because it is a model input
+            "beatmap_idx": sequence.beatmap_idx,
+            "decoder_input_ids": input_tokens,
+            "decoder_attention_mask": attention_mask,
+            "labels": label_tokens,
+        }
 
-        return sequence
-
-    def _pad_frame_sequence(self, sequence: dict) -> dict:
+    def _pad_frame_sequence(self, sequence: Sequence) -> Sequence:
         """Pad frame sequence with zeros until `frame_seq_len`.
 
         Frame sequence can be further processed into Mel spectrogram frames,
@@ -514,20 +661,17 @@ class BeatmapDatasetIterable:
         Returns:
             The same sequence with padded frames.
         """
-        frames = torch.from_numpy(sequence["frames"]).to(torch.float32)
-
-        if frames.shape[0] != self.frame_seq_len:
-            n = min(self.frame_seq_len, len(frames))
-            padded_frames = torch.zeros(
-                self.frame_seq_len,
-                frames.shape[-1],
-                dtype=frames.dtype,
-                device=frames.device,
-            )
-            padded_frames[:n] = frames[:n]
-            sequence["frames"] = torch.flatten(padded_frames)
+        hop_length = self.args.hop_length
+        n = min(self.frame_seq_len, len(sequence.frames))
+        # Frames stay int16 until the spectrogram layer, this does not copy if the frames are contiguous
+        frames = torch.from_numpy(np.ascontiguousarray(sequence.frames[:n])).view(-1)
+
+        if n != self.frame_seq_len:
+            padded_frames = torch.zeros(self.frame_seq_len * hop_length, dtype=frames.dtype)
+            padded_frames[:n * hop_length] = frames
+            sequence.frames = padded_frames
         else:
-            sequence["frames"] = torch.flatten(frames)
+            sequence.frames = frames
 
         return sequence
 
@@ -544,70 +688,85 @@ class BeatmapDatasetIterable:
         return self._get_next_tracks() if self.args.per_track else self._get_next_beatmaps()
 
     @staticmethod
-    def _load_metadata(track_path: Path) -> dict:
+    @lru_cache(maxsize=1024)
+    def _load_metadata(track_path: Path) -> dict[str, BeatmapMetadata]:
         metadata_file = track_path / "metadata.json"
-        with open(metadata_file) as f:
-            return json.load(f)
-
-    @staticmethod
-    def _get_difficulty(metadata: dict, beatmap_name: str):
-        return metadata["Beatmaps"][beatmap_name]["StandardStarRating"]["0"]
+        with open(metadata_file, "rb") as f:
+            metadata = orjson.loads(f.read())
+        return {
+            beatmap_name: BeatmapMetadata(
+                index=beatmap_metadata["Index"],
+                difficulty=beatmap_metadata["StandardStarRating"]["0"],
+            )
+            for beatmap_name, beatmap_metadata in metadata["Beatmaps"].items()
+        }
 
     @staticmethod
-    def _get_idx(metadata: dict, beatmap_name: str):
-        return metadata["Beatmaps"][beatmap_name]["Index"]
+    @lru_cache(maxsize=1024)
+    def _get_audio_path(track_path: Path) -> Path:
+        audio_path = next(track_path.glob("audio.*"), None)
+        if audio_path is None:
+            raise FileNotFoundError(f"No audio file found in {track_path}.")
+        return audio_path
 
     def _get_next_beatmaps(self) -> dict:
-        for beatmap_path in self.beatmap_files:
-            metadata = self._load_metadata(beatmap_path.parents[1])
+        # Consecutive beatmaps of the same track share the loaded audio
+        for track_path, beatmap_paths in itertools.groupby(self.beatmap_files, key=lambda p: p.parents[1]):
+            metadata = self._load_metadata(track_path)
 
-            if self.args.add_gd_context and len(metadata["Beatmaps"]) <= 1:
+            if self.args.add_gd_context and len(metadata) <= 1:
                 continue
 
-            audio_path = beatmap_path.parents[1] / list(beatmap_path.parents[1].glob('audio.*'))[0]
+            audio_path = self._get_audio_path(track_path)
             audio_samples = load_audio_file(audio_path, self.args.sample_rate)
+            frames = self._get_frames(audio_samples)
 
-            for sample in self._get_next_beatmap(audio_samples, beatmap_path, metadata):
-                yield sample
+            for beatmap_path in beatmap_paths:
+                for sample in self._get_next_beatmap(frames, beatmap_path, metadata):
+                    yield sample
 
     def _get_next_tracks(self) -> dict:
         for track_path in self.beatmap_files:
             metadata = self._load_metadata(track_path)
 
-            if self.args.add_gd_context and len(metadata["Beatmaps"]) <= 1:
+            if self.args.add_gd_context and len(metadata) <= 1:
                 continue
 
-            audio_path = track_path / list(track_path.glob('audio.*'))[0]
+            audio_path = self._get_audio_path(track_path)
             audio_samples = load_audio_file(audio_path, self.args.sample_rate)
+            frames = self._get_frames(audio_samples)
 
-            for beatmap_name in metadata["Beatmaps"]:
+            for beatmap_name in metadata:
                 beatmap_path = (track_path / "beatmaps" / beatmap_name).with_suffix(".osu")
 
-                for sample in self._get_next_beatmap(audio_samples, beatmap_path, metadata):
+                for sample in self._get_next_beatmap(frames, beatmap_path, metadata):
                     yield sample
 
-    def _get_next_beatmap(self, audio_samples, beatmap_path: Path, metadata: dict) -> dict:
+    def _get_next_beatmap(
+            self,
+            frames: npt.NDArray,
+            beatmap_path: Path,
+            metadata: dict[str, BeatmapMetadata],
+    ) -> dict:
         beatmap_name = beatmap_path.stem
-        frames, frame_times = self._get_frames(audio_samples)
 
         other_events, other_idx, other_difficulty = None, None, None
         if self.args.add_gd_context:
-            other_beatmaps = [k for k in metadata["Beatmaps"] if k != beatmap_name]
+            other_beatmaps = [k for k in metadata if k != beatmap_name]
             other_name = random.choice(other_beatmaps)
             other_beatmap_path = (beatmap_path.parent / other_name).with_suffix(".osu")
             other_beatmap = Beatmap.from_path(other_beatmap_path)
-            other_events = self.parser.parse(other_beatmap)
-            other_idx = self._get_idx(metadata, other_name)
-            other_difficulty = self._get_difficulty(metadata, other_name)
+            other_events = EventArray.from_events(self.parser.parse(other_beatmap))
+            other_idx = metadata[other_name].index
+            other_difficulty = metadata[other_name].difficulty
 
         osu_beatmap = Beatmap.from_path(beatmap_path)
-        events = self.parser.parse(osu_beatmap)
-        current_idx = self._get_idx(metadata, beatmap_name)
-        difficulty = self._get_difficulty(metadata, beatmap_name)
+        events = EventArray.from_events(self.parser.parse(osu_beatmap))
+        current_idx = metadata[beatmap_name].index
+        difficulty = metadata[beatmap_name].difficulty
 
         sequences = self._create_sequences(
             frames,
-            frame_times,
             events,
             current_idx,
             difficulty,
@@ -44,7 +44,7 @@ class Preprocessor(object):
             [0, self.sequence_stride - (len(samples) - self.samples_per_sequence) % self.sequence_stride],
         )
         sequences = self.window(samples, self.samples_per_sequence, self.sequence_stride)
-        sequences = torch.from_numpy(sequences).to(torch.float32)
+        sequences = torch.from_numpy(np.ascontiguousarray(sequences))
         return sequences
 
     @staticmethod
@@ -85,7 +85,7 @@ class OsuT(nn.Module):
             **kwargs
     ) -> Seq2SeqLMOutput:
         """
-        frames: B x L_encoder x mel_bins, float32
+        frames: B x L_samples, int16 or float32
         decoder_input_ids: B x L_decoder, int64
         beatmap_idx: B, int64
         beatmap_id: B, int64
@@ -46,10 +46,13 @@ class MelSpectrogram(nn.Module):
 
         Args:
             samples: Audio time-series (batch size, n_samples).
+                Integer samples are scaled from their full range to [-1, 1].
 
         Returns:
             A batch of Mel spectrograms of size (batch size, n_frames, n_mels).
         """
+        if not samples.is_floating_point():
+            samples = samples.float() / torch.iinfo(samples.dtype).max
         spectrogram = self.transform(samples)
         spectrogram = spectrogram.permute(0, 2, 1)
         return spectrogram
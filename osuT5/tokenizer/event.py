@@ -3,6 +3,9 @@ from __future__ import annotations
 import dataclasses
 from enum import Enum
 
+import numpy as np
+import numpy.typing as npt
+
 
 class EventType(Enum):
     TIME_SHIFT = "t"
@@ -41,3 +44,30 @@ class Event:
 
     def __str__(self) -> str:
         return f"{self.type.value}{self.value}"
+
+
+EVENT_TYPES: list[EventType] = list(EventType)
+EVENT_TYPE_IDS: dict[EventType, int] = {t: i for i, t in enumerate(EVENT_TYPES)}
+
+
+@dataclasses.dataclass
+class EventArray:
+    """Struct-of-arrays representation of a list of Event objects.
+
+    Event types are stored as their index in `EVENT_TYPES`, so slicing
+    produces views instead of copying Event objects.
+    """
+    types: npt.NDArray[np.int8]
+    values: npt.NDArray[np.float32]
+
+    @classmethod
+    def from_events(cls, events: list[Event]) -> EventArray:
+        types = np.fromiter((EVENT_TYPE_IDS[e.type] for e in events), dtype=np.int8, count=len(events))
+        values = np.fromiter((e.value for e in events), dtype=np.float32, count=len(events))
+        return cls(types, values)
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def __getitem__(self, item: slice) -> EventArray:
+        return EventArray(self.types[item], self.values[item])
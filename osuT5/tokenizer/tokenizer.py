@@ -1,12 +1,14 @@
 import json
 import pickle
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
+import numpy.typing as npt
 from omegaconf import DictConfig
 from tqdm import tqdm
 
-from .event import Event, EventType, EventRange
+from .event import Event, EventType, EventRange, EVENT_TYPES
 
 MILISECONDS_PER_SECOND = 1000
 MILISECONDS_PER_STEP = 10
@@ -26,6 +28,9 @@ class Tokenizer:
         "vocab_size_out",
         "vocab_size_in",
         "beatmap_idx",
+        "_type_offset",
+        "_type_min_value",
+        "_type_max_value",
     ]
 
     def __init__(self, args: DictConfig = None):
@@ -94,6 +99,22 @@ class Tokenizer:
             er.max_value - er.min_value + 1 for er in self.input_event_ranges
         )
 
+        self._init_type_lut()
+
+    def _init_type_lut(self) -> None:
+        """Initializes lookup tables indexed by event type id for vectorized encoding."""
+        self._type_offset = np.zeros(len(EVENT_TYPES), dtype=np.int64)
+        # Unknown event types get an empty value range
+        self._type_min_value = np.ones(len(EVENT_TYPES), dtype=np.int64)
+        self._type_max_value = np.zeros(len(EVENT_TYPES), dtype=np.int64)
+        for i, event_type in enumerate(EVENT_TYPES):
+            if event_type not in self.event_range:
+                continue
+            er = self.event_range[event_type]
+            self._type_offset[i] = self.event_start[event_type] - er.min_value
+            self._type_min_value[i] = er.min_value
+            self._type_max_value[i] = er.max_value
+
     @property
     def pad_id(self) -> int:
         """[PAD] token for padding."""
@@ -139,6 +160,32 @@ class Tokenizer:
 
         return offset + event.value - er.min_value
 
+    def encode_array(
+            self,
+            types: npt.NDArray,
+            values: npt.NDArray,
+            out: Optional[npt.NDArray[np.int64]] = None,
+    ) -> npt.NDArray[np.int64]:
+        """Converts arrays of event type ids and values into token ids.
+
+        If `out` is given, the token ids are written into it and it is returned.
+        """
+        values = values.astype(np.int64)
+        invalid = (values < self._type_min_value[types]) | (values > self._type_max_value[types])
+
+        if invalid.any():
+            i = np.flatnonzero(invalid)[0]
+            event_type = EVENT_TYPES[types[i]]
+            if event_type not in self.event_range:
+                raise ValueError(f"unknown event type: {event_type}")
+            er = self.event_range[event_type]
+            raise ValueError(
+                f"event value {values[i]} is not within range "
+                f"[{er.min_value}, {er.max_value}] for event type {event_type}"
+            )
+
+        return np.add(self._type_offset[types], values, out=out)
+
     def event_type_range(self, event_type: EventType) -> tuple[int, int]:
         """Get the token id range of each Event type."""
         if event_type not in self.event_range:
@@ -235,3 +282,4 @@ class Tokenizer:
         self.vocab_size_out = state_dict["vocab_size_out"]
         self.vocab_size_in = state_dict["vocab_size_in"]
         self.beatmap_idx = state_dict["beatmap_idx"]
+        self._init_type_lut()
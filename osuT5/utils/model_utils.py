@@ -112,12 +112,16 @@ def get_scheduler(optimizer: Optimizer, args: DictConfig) -> LRScheduler:
 
 def get_dataloaders(tokenizer: Tokenizer, args: DictConfig, shared: Namespace) -> tuple[DataLoader, DataLoader]:
     parser = OsuParser(tokenizer)
+    batch_size = args.optim.batch_size // args.optim.grad_acc
+    # Batches are collated in the workers instead of by the DataLoader
+    worker_batch_size = batch_size if args.data.worker_batch else None
     dataset = {
         "train": OrsDataset(
             args.data,
             parser,
             tokenizer,
             shared=shared,
+            batch_size=worker_batch_size,
         ),
         "test": OrsDataset(
             args.data,
@@ -125,16 +129,15 @@ def get_dataloaders(tokenizer: Tokenizer, args: DictConfig, shared: Namespace) -
             tokenizer,
             test=True,
             shared=shared,
+            batch_size=worker_batch_size,
         ),
     }
 
     dataloaders = {}
     for split in ["train", "test"]:
-        batch_size = args.optim.batch_size // args.optim.grad_acc
-
         dataloaders[split] = DataLoader(
             dataset[split],
-            batch_size=batch_size,
+            batch_size=None if args.data.worker_batch else batch_size,
             num_workers=args.dataloader.num_workers,
             pin_memory=True,
             drop_last=False,